@@ -0,0 +1,58 @@
+"""
+Upload handling shared by the image API views.
+"""
+import hashlib
+import itertools
+import os
+import time
+from collections import namedtuple
+
+from django.conf import settings
+
+# Unique file names: boot time, process id and a per-process counter, plus
+# a random token so published names cannot be guessed from one another
+_UID_PREFIX = f"{int(time.time()):x}"
+_UID_COUNTER = itertools.count()
+
+# data: upload bytes, digest: blake2b hash for the result cache,
+# unique_id: file name prefix, path: saved copy on disk or None
+Upload = namedtuple('Upload', ['data', 'digest', 'unique_id', 'path'])
+
+
+def next_unique_id():
+    """Return an unguessable file name prefix unique across requests and worker processes."""
+    return f"{_UID_PREFIX}-{os.getpid():x}-{next(_UID_COUNTER):x}-{os.urandom(8).hex()}"
+
+
+def receive_upload(image_file, upload_dir, keep_disk=None):
+    """
+    Read an uploaded file into memory and hash it for the result cache.
+
+    With keep_disk (default: the KEEP_UPLOADS setting) the chunks are also
+    written to upload_dir in the same loop that hashes them; otherwise
+    the disk is never touched.
+    """
+    if keep_disk is None:
+        keep_disk = settings.KEEP_UPLOADS
+    unique_id = next_unique_id()
+
+    if not keep_disk:
+        data = image_file.read()
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        return Upload(data, digest, unique_id, None)
+
+    path = f"{upload_dir}/{unique_id}_{image_file.name}"
+    digest = hashlib.blake2b(digest_size=16)
+    chunks = []
+    with open(path, 'wb+') as destination:
+        for chunk in image_file.chunks():
+            digest.update(chunk)
+            chunks.append(chunk)
+            destination.write(chunk)
+    return Upload(b''.join(chunks), digest.digest(), unique_id, path)
+
+
+def discard_upload(upload):
+    """Delete the saved copy of an upload, if any."""
+    if upload.path is not None and os.path.exists(upload.path):
+        os.unlink(upload.path)
@@ -1,5 +1,36 @@
+import hashlib
+import os
+import sys
+
 from django.apps import AppConfig
+from django.conf import settings
+
+
+def _is_runserver():
+    """Whether this process is the one serving requests under `manage.py runserver`."""
+    if os.path.basename(sys.argv[0]) != 'manage.py' or len(sys.argv) < 2 or sys.argv[1] != 'runserver':
+        return False
+    # Skip the autoreloader parent; only the child serves requests
+    return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv
 
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from .inference_client import InferenceClient, configure_threads
+        from .views import MEDIA_DIRS
+
+        configure_threads()
+
+        for path in MEDIA_DIRS:
+            os.makedirs(path, exist_ok=True)
+
+        # YOLO runs in a warm worker process that the client starts lazily on
+        # the first request; migrate, tests and scripts never load it. Every
+        # Django process of this checkout derives the same address and key,
+        # so they all share one worker.
+        authkey = hashlib.blake2b(settings.SECRET_KEY.encode(), digest_size=16, person=b'bg-inference').digest()
+        self.client = InferenceClient(settings.BASE_DIR, authkey)
+        if settings.INFERENCE_WORKER_AUTOSTART or _is_runserver():
+            self.client.start()
@@ -0,0 +1,296 @@
+"""
+Client side of the warm YOLO inference worker.
+
+Django processes only need this module: it starts the worker, letterboxes
+images and exchanges them over shared memory, and it imports neither torch
+nor ultralytics, which stay in the worker process (see inference_worker).
+"""
+import getpass
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from multiprocessing.connection import Client
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import cv2
+
+# Seconds a client waits for the worker to finish loading the model
+READY_TIMEOUT = 120
+
+# Seconds a client waits for one mask before giving up on the worker
+REPLY_TIMEOUT = 60
+
+# Fixed inference size; every image is letterboxed to IMGSZ x IMGSZ so the
+# compiled graph always sees the same input shape
+IMGSZ = 640
+
+# Size of every shared buffer: clients send the letterboxed IMGSZ x IMGSZ
+# BGR image and get back a float32 mask of at most IMGSZ x IMGSZ, so the
+# buffer never depends on the upload's resolution
+SHM_BYTES = IMGSZ * IMGSZ * 4
+
+# Idle worker connections (each with its shared buffer) a client keeps for
+# reuse; one per image in a full worker batch
+POOL_SIZE = 8
+
+
+def server_threads():
+    """Threads each server process may use: OMP_NUM_THREADS, default 1."""
+    return int(os.environ.get('OMP_NUM_THREADS', '1'))
+
+
+def configure_threads():
+    """
+    Pin a server process's OpenCV and torch pools to OMP_NUM_THREADS (default 1).
+
+    Each server worker gets its own pools, so letting every one of them use
+    all cores oversubscribes the CPU and thrashes the shared caches. The
+    inference worker is sized separately, see _configure_worker_threads().
+    """
+    threads = server_threads()
+    cv2.setNumThreads(threads)
+    cv2.ocl.setUseOpenCL(False)
+    # Server processes never run the model, so torch is only configured if
+    # something else already imported it
+    torch = sys.modules.get('torch')
+    if torch is not None:
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # Already set, or parallel work has started in this process
+            pass
+
+
+def _letterbox(img, size=IMGSZ):
+    """Resize and pad an image to a size x size square, the way YOLO does."""
+    h, w = img.shape[:2]
+    gain = min(size / h, size / w)
+    nh, nw = round(h * gain), round(w * gain)
+    if (nh, nw) != (h, w):
+        img = cv2.resize(img, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    dh, dw = (size - nh) / 2, (size - nw) / 2
+    top, bottom = round(dh - 0.1), round(dh + 0.1)
+    left, right = round(dw - 0.1), round(dw + 0.1)
+    return cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+
+
+def _crop_letterbox(seg_mask, shape):
+    """Crop the letterbox padding YOLO adds around the input from a mask."""
+    h, w = shape
+    mh, mw = seg_mask.shape[-2:]
+    gain = min(mh / h, mw / w)
+    pad_x = int((mw - w * gain) / 2)
+    pad_y = int((mh - h * gain) / 2)
+    return seg_mask[..., pad_y:mh - pad_y, pad_x:mw - pad_x]
+
+
+def _worker_address(base_dir, authkey, model_size='n'):
+    """
+    Return the (address, lock_path) every Django process uses for the worker.
+
+    The name is derived from the project directory, the user and the
+    authkey, so all processes of one checkout meet at the same socket while
+    other checkouts and deployments on the host, which may run different
+    code or weights, get their own worker.
+    """
+    scope = f"{base_dir}\0{getpass.getuser()}\0".encode()
+    digest = hashlib.blake2b(scope + authkey, digest_size=6).hexdigest()
+    name = f"bg-remover-{digest}-{model_size}"
+    lock_path = os.path.join(tempfile.gettempdir(), f"{name}.lock")
+    if sys.platform == 'win32':
+        return rf'\\.\pipe\{name}', lock_path
+    return os.path.join(tempfile.gettempdir(), f"{name}.sock"), lock_path
+
+
+def _try_lock(path):
+    """
+    Take an exclusive lock on path without blocking; return the open file, or None.
+
+    None also covers a lock file that cannot be opened, e.g. one left in the
+    temp directory by another user.
+    """
+    f = None
+    try:
+        f = open(path, 'a+b')
+        if sys.platform == 'win32':
+            import msvcrt
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        if f is not None:
+            f.close()
+        return None
+    return f
+
+
+def _unlink(shm, owner_pid):
+    """Close and unlink a shared memory block, only in the process that created it."""
+    if os.getpid() != owner_pid:
+        # Inherited across fork; the parent still uses the block
+        return
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class _Channel:
+    """A connection to the worker and the shared buffer exchanged over it."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.shm = SharedMemory(create=True, size=SHM_BYTES)
+        # Unlinked when the channel is closed, garbage collected or the
+        # process exits; SharedMemory itself only closes on collection
+        self._finalizer = weakref.finalize(self, _unlink, self.shm, os.getpid())
+
+    def close(self):
+        self._finalizer()
+        self.conn.close()
+
+
+class InferenceClient:
+    """
+    Handle to the warm inference worker shared by all Django processes.
+
+    Requests borrow a connection and shared memory buffer from a small pool,
+    so concurrent requests do not serialize on one socket and short-lived
+    request threads do not leave buffers behind.
+    """
+
+    def __init__(self, base_dir, authkey, model_size='n'):
+        self.model_size = model_size
+        self._base_dir = base_dir
+        self._authkey = authkey
+        self._address, self._lock_path = _worker_address(base_dir, authkey, model_size)
+        self.log_path = os.path.splitext(self._lock_path)[0] + '.log'
+        self._process = None
+        self._process_owner = None
+        self._lock = threading.Lock()
+        self._pool_lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+
+    def _worker_running(self):
+        """Whether a worker is serving, or loading for, this client's address."""
+        # A Popen inherited across fork (gunicorn --preload) belongs to the
+        # parent; only the process that started the worker can poll it
+        if self._process_owner == os.getpid() and self._process.poll() is None:
+            return True
+        lock = _try_lock(self._lock_path)
+        if lock is None:
+            return True
+        lock.close()
+        return False
+
+    def start(self):
+        """
+        Start the worker process unless one already serves this address.
+
+        The worker runs detached in its own session, so it outlives the Django
+        process that happened to start it (gunicorn max_requests recycling,
+        HUP or runserver reloads) and the others keep a warm model. It runs
+        from base_dir, where the model files are looked up, and logs to a
+        file next to its lock rather than holding the server's output open.
+        """
+        with self._lock:
+            if self._worker_running():
+                return
+            if sys.platform == 'win32':
+                detach = {'creationflags': subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP}
+            else:
+                detach = {'start_new_session': True}
+            # Should several Django processes race here, the worker that takes
+            # the lock serves and the others exit
+            with open(self.log_path, 'ab') as log:
+                self._process = subprocess.Popen(
+                    [sys.executable, '-u', '-m', 'api.inference_worker', self._address, self._lock_path, self.model_size],
+                    cwd=self._base_dir,
+                    stdin=subprocess.PIPE,
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                    **detach,
+                )
+            self._process_owner = os.getpid()
+            # Passed on stdin so the key never shows up in the process list
+            self._process.stdin.write(self._authkey.hex().encode() + b'\n')
+            self._process.stdin.close()
+
+    def _connect(self):
+        """Connect to the worker, waiting while it loads the model."""
+        self.start()
+        deadline = time.monotonic() + READY_TIMEOUT
+        while True:
+            try:
+                return Client(self._address, authkey=self._authkey)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Inference worker did not start in time")
+                if not self._worker_running():
+                    raise RuntimeError("Inference worker exited during startup")
+                time.sleep(0.1)
+
+    def _acquire(self):
+        with self._pool_lock:
+            if self._pid != os.getpid():
+                # Forked: the parent's connections are not ours to use
+                self._idle = []
+                self._pid = os.getpid()
+            if self._idle:
+                return self._idle.pop()
+        conn = self._connect()
+        try:
+            return _Channel(conn)
+        except Exception:
+            conn.close()
+            raise
+
+    def _release(self, channel):
+        with self._pool_lock:
+            if self._pid == os.getpid() and len(self._idle) < POOL_SIZE:
+                self._idle.append(channel)
+                return
+        channel.close()
+
+    def infer(self, img, conf_threshold=0.25):
+        """Return the low-resolution float32 person mask (0-1) for a BGR image."""
+        # Letterboxed here, so only IMGSZ x IMGSZ pixels cross shared memory
+        # whatever the upload's resolution
+        boxed = _letterbox(img)
+        channel = self._acquire()
+        reusable = False
+        try:
+            # Temporary views only: the buffer cannot be closed while one is alive
+            np.ndarray(boxed.shape, dtype=np.uint8, buffer=channel.shm.buf)[...] = boxed
+
+            try:
+                channel.conn.send((channel.shm.name, img.shape[:2], conf_threshold))
+                if not channel.conn.poll(REPLY_TIMEOUT):
+                    raise RuntimeError("Inference worker did not reply in time")
+                reply = channel.conn.recv()
+            except (EOFError, OSError):
+                # Worker went away; the next request reconnects, respawning it
+                raise RuntimeError("Inference worker connection lost")
+
+            # An error reply leaves the connection in step; anything else
+            # that goes wrong closes the channel rather than pooling it
+            reusable = True
+            if reply[0] == 'error':
+                raise RuntimeError(reply[1])
+            _, shape, dtype = reply
+            return np.ndarray(shape, dtype=dtype, buffer=channel.shm.buf).copy()
+        finally:
+            if reusable:
+                self._release(channel)
+            else:
+                channel.close()
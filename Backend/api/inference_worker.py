@@ -0,0 +1,347 @@
+"""
+Warm YOLO inference worker.
+
+The segmentation model is loaded once in a dedicated process and serves
+mask requests from all Django workers over one well-known local socket.
+Images and masks are exchanged through shared memory so only small headers
+cross the socket. Django processes talk to it through inference_client.
+"""
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import cv2
+import torch
+
+from .inference_client import IMGSZ, _crop_letterbox, _try_lock
+
+# Global model instance (loaded once per worker process)
+_model = None
+
+# Seconds a starting worker retries the address lock; clients probing
+# whether a worker is running hold it for an instant
+LOCK_WAIT = 2
+
+# Micro-batching limits for concurrent requests
+MAX_BATCH = 8
+MAX_WAIT_MS = 15
+
+# Largest mask the pinned readback buffers hold (the inference size)
+PINNED_MASK_PIXELS = IMGSZ * IMGSZ
+
+
+def _configure_worker_threads():
+    """
+    Size the inference worker's thread pools from INFERENCE_THREADS.
+
+    The worker is the one process running the model, so it defaults to all
+    cores rather than the OMP_NUM_THREADS it inherits from the server.
+    """
+    threads = int(os.environ.get('INFERENCE_THREADS', os.cpu_count() or 1))
+    cv2.setNumThreads(threads)
+    cv2.ocl.setUseOpenCL(False)
+    torch.set_num_threads(threads)
+
+
+def _exported_model(model_size='n'):
+    """Return the path of a compiled export of the model, if one was built."""
+    cuda = torch.cuda.is_available()
+    for version in ('yolov11', 'yolov10', 'yolov8'):
+        stem = f'{version}{model_size}-seg'
+        # TensorRT engines only run on CUDA hosts
+        if cuda and Path(f'{stem}.engine').exists():
+            return f'{stem}.engine'
+        if Path(f'{stem}_openvino_model').is_dir():
+            return f'{stem}_openvino_model'
+    return None
+
+
+def get_model(model_size='n'):
+    """Load and cache the YOLO model, preferring an OpenVINO/TensorRT export."""
+    global _model
+    if _model is None:
+        from ultralytics import YOLO
+
+        exported = _exported_model(model_size)
+        if exported is not None:
+            print(f"Loading exported model {exported}...")
+            _model = YOLO(exported, task='segment')
+            print("Model loaded successfully!")
+            return _model
+
+        print(f"Loading YOLOv8{model_size}-seg model...")
+        try:
+            _model = YOLO(f'yolov11{model_size}-seg.pt')
+        except Exception:
+            try:
+                _model = YOLO(f'yolov10{model_size}-seg.pt')
+            except Exception:
+                _model = YOLO(f'yolov8{model_size}-seg.pt')
+        print("Model loaded successfully!")
+    return _model
+
+
+def _predict(model, source, conf_threshold=0.25, class_id=0):
+    """Run YOLO without autograd bookkeeping, in FP16 on CUDA."""
+    with torch.inference_mode():
+        return model(source, conf=conf_threshold, classes=[class_id], half=torch.cuda.is_available(), verbose=False)
+
+
+def _filter_result(result, conf_threshold):
+    """Drop detections below conf_threshold (batched calls run at the lowest one)."""
+    if result.boxes is not None and len(result.boxes) > 0:
+        result = result[result.boxes.conf >= conf_threshold]
+    return result
+
+
+def _device_mask(result, shape):
+    """
+    Combine a result's segmentation masks on their device, or None without masks.
+
+    Masks are combined at YOLO's own mask resolution in one kernel and kept as
+    float32 in [0, 1]; the caller upsamples once and uses it as soft alpha.
+    """
+    if result.masks is None or len(result.masks.data) == 0:
+        return None
+    masks_data = _crop_letterbox(result.masks.data, shape)
+    # A single detection (the common case) needs no reduction
+    mask = masks_data[0] if len(masks_data) == 1 else masks_data.amax(dim=0)
+    return mask.float()
+
+
+def _box_mask(result, shape):
+    """Mask from bounding boxes, for models without mask output."""
+    # Drawn on the letterboxed input, like the segmentation masks
+    mask = np.zeros(result.orig_shape, dtype=np.float32)
+    boxes = result.boxes
+    if boxes is not None and len(boxes) > 0:
+        for x1, y1, x2, y2 in boxes.xyxy.cpu().numpy().astype(int):
+            mask[y1:y2, x1:x2] = 1.0
+    return _crop_letterbox(mask, shape)
+
+
+class BatchScheduler(threading.Thread):
+    """
+    Owns the model and coalesces concurrent requests into one forward pass.
+
+    Requests are drained until MAX_BATCH images are queued or MAX_WAIT_MS has
+    passed since the first one arrived, whichever comes first.
+    """
+
+    def __init__(self, model, class_id=0, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS):
+        super().__init__(name='yolo-batcher', daemon=True)
+        self.model = model
+        self.class_id = class_id
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+
+        # Page-locked staging buffers let mask readbacks run as async copies
+        # on a side stream, with a single sync per batch
+        if torch.cuda.is_available():
+            self._stream = torch.cuda.Stream()
+            self._pinned = torch.empty((max_batch, PINNED_MASK_PIXELS), dtype=torch.float32, pin_memory=True)
+        else:
+            self._stream = None
+
+    def submit(self, img, shape, conf_threshold=0.25):
+        """
+        Queue a letterboxed BGR image of original (h, w) shape.
+
+        The returned future resolves to its mask.
+        """
+        future = Future()
+        self._queue.put((img, shape, conf_threshold, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _readback(self, masks):
+        """Copy device masks to host numpy arrays."""
+        if self._stream is None:
+            return [m.cpu().numpy() if torch.is_tensor(m) else m for m in masks]
+
+        self._stream.wait_stream(torch.cuda.current_stream())
+        staged = []
+        with torch.cuda.stream(self._stream):
+            for i, mask in enumerate(masks):
+                if torch.is_tensor(mask) and mask.numel() <= self._pinned.shape[1]:
+                    host = self._pinned[i, :mask.numel()].view(mask.shape)
+                    host.copy_(mask, non_blocking=True)
+                    staged.append(host)
+                elif torch.is_tensor(mask):
+                    staged.append(mask.cpu().numpy())
+                else:
+                    staged.append(mask)
+        self._stream.synchronize()
+        # The pinned buffers are reused by the next batch
+        return [m.numpy().copy() if torch.is_tensor(m) else m for m in staged]
+
+    def _run_batch(self, batch):
+        imgs = [img for img, _, _, _ in batch]
+        min_conf = min(conf for _, _, conf, _ in batch)
+        try:
+            results = _predict(self.model, imgs, min_conf, self.class_id)
+            masks = []
+            for (_, shape, conf, _), result in zip(batch, results):
+                result = _filter_result(result, conf)
+                mask = _device_mask(result, shape)
+                masks.append(_box_mask(result, shape) if mask is None else mask)
+            for (_, _, _, future), mask in zip(batch, self._readback(masks)):
+                future.set_result(mask)
+        except Exception as e:
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def run(self):
+        while True:
+            self._run_batch(self._next_batch())
+
+
+def _warm_up(model):
+    """Initialise CUDA and run a dummy inference so the first request is hot."""
+    if torch.cuda.is_available():
+        torch.cuda.init()
+    _predict(model, np.zeros((IMGSZ, IMGSZ, 3), dtype=np.uint8))
+
+
+def _compile(model):
+    """
+    Compile the PyTorch graph with torch.compile on CUDA hosts.
+
+    The input is always IMGSZ x IMGSZ, so only the batch dimension varies:
+    tracing batch sizes 1 and 2 at boot gives a graph for single images and
+    one with a dynamic batch for everything up to MAX_BATCH, without using
+    up dynamo's recompile limit. CPU hosts keep the eager model, since
+    inductor can take minutes to compile there and the OpenVINO export is
+    the faster CPU path. Exported models are already compiled; if
+    compilation fails the eager model is kept.
+    """
+    backend = model.predictor.model
+    if not torch.cuda.is_available() or not getattr(backend, 'pt', False) or not hasattr(torch, 'compile'):
+        return
+
+    eager = backend.model
+    backend.model = torch.compile(eager, mode='reduce-overhead', fullgraph=False)
+    blank = np.zeros((IMGSZ, IMGSZ, 3), dtype=np.uint8)
+    try:
+        for batch_size in (1, 2):
+            _predict(model, [blank] * batch_size)
+    except Exception as e:
+        print(f"torch.compile failed, using the eager model: {e}")
+        backend.model = eager
+
+
+def _attach(name):
+    """Attach to a client-owned shared memory block without tracking it here."""
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=name, track=False)
+    # Older versions register the block on attach. Unregistering it again is
+    # not safe: a spawned worker shares its parent's resource tracker, where
+    # that would drop the client's own registration. Registering twice is a
+    # no-op, and the client unlinks the block when it is done with it.
+    return SharedMemory(name=name)
+
+
+def _serve(conn, scheduler):
+    """Answer mask requests on one client connection until it closes."""
+    shm = None
+    try:
+        while True:
+            try:
+                name, shape, conf_threshold = conn.recv()
+            except (EOFError, OSError):
+                break
+
+            try:
+                if shm is None or shm.name != name:
+                    if shm is not None:
+                        shm.close()
+                    shm = _attach(name)
+
+                # The predictor keeps references to its inputs, so it gets a
+                # private copy of the letterboxed image, not the shared buffer
+                img = np.ndarray((IMGSZ, IMGSZ, 3), dtype=np.uint8, buffer=shm.buf).copy()
+                mask = scheduler.submit(img, shape, conf_threshold).result()
+
+                if mask.nbytes > shm.size:
+                    raise ValueError("Mask does not fit in the shared buffer")
+                out = np.ndarray(mask.shape, dtype=mask.dtype, buffer=shm.buf)
+                out[...] = mask
+                del out
+                reply = ('ok', mask.shape, mask.dtype.str)
+            except Exception as e:
+                reply = ('error', str(e))
+
+            try:
+                conn.send(reply)
+            except OSError:
+                # The client gave up on this request and closed the connection
+                break
+    finally:
+        if shm is not None:
+            shm.close()
+        conn.close()
+
+
+def run(address, lock_path, authkey, model_size='n'):
+    """Worker entry point: load the model once, then serve requests forever."""
+    # Held for the life of the process: only one worker serves an address, and
+    # clients treat a held lock as "running or still loading".
+    deadline = time.monotonic() + LOCK_WAIT
+    lock = _try_lock(lock_path)
+    while lock is None:
+        if time.monotonic() > deadline:
+            # Another worker serves this address
+            return
+        time.sleep(0.05)
+        lock = _try_lock(lock_path)
+
+    _configure_worker_threads()
+    model = get_model(model_size)
+    _warm_up(model)
+    _compile(model)
+    scheduler = BatchScheduler(model)
+    scheduler.start()
+
+    # A socket left behind by a dead worker; safe to remove under the lock
+    if isinstance(address, str) and os.path.exists(address):
+        os.unlink(address)
+
+    # Clients connect as soon as the listener exists, so it is only opened
+    # once the model is warm
+    with Listener(address, authkey=authkey) as listener:
+        while True:
+            try:
+                conn = listener.accept()
+            except (EOFError, OSError, AuthenticationError):
+                # The handshake runs inside accept(); a client that drops
+                # early or has the wrong key must not take the worker down
+                continue
+            threading.Thread(target=_serve, args=(conn, scheduler), daemon=True).start()
+
+
+if __name__ == '__main__':
+    # Started by InferenceClient.start() with the authkey on stdin
+    address, lock_path, model_size = sys.argv[1:]
+    run(address, lock_path, bytes.fromhex(sys.stdin.readline().strip()), model_size)
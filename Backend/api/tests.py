@@ -1,3 +1,417 @@
-from django.test import TestCase
+import hashlib
+import os
+import shutil
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy as np
+import torch
+from django.apps import apps
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from . import inference_worker, views
+from ._upload import discard_upload, next_unique_id, receive_upload
+from .inference_client import IMGSZ, _crop_letterbox, _letterbox
+
+
+def clear_result_cache():
+    with views._result_cache_lock:
+        views._RESULT_CACHE.clear()
+        views._result_cache_bytes = 0
+
+
+class ResultCacheTests(SimpleTestCase):
+    def setUp(self):
+        clear_result_cache()
+        self.addCleanup(clear_result_cache)
+
+    def test_get_returns_cached_entry(self):
+        views.cache_put('a', b'data', 'image/png')
+        self.assertEqual(views.cache_get('a'), (b'data', 'image/png', None))
+        self.assertIsNone(views.cache_get('missing'))
+
+    def test_evicts_least_recently_used_by_item_count(self):
+        with mock.patch.object(views, 'RESULT_CACHE_MAX_ITEMS', 2):
+            views.cache_put('a', b'1', 'image/png')
+            views.cache_put('b', b'2', 'image/png')
+            views.cache_get('a')
+            views.cache_put('c', b'3', 'image/png')
+
+        self.assertIsNotNone(views.cache_get('a'))
+        self.assertIsNone(views.cache_get('b'))
+        self.assertIsNotNone(views.cache_get('c'))
+
+    def test_evicts_by_total_bytes(self):
+        with mock.patch.object(views, 'RESULT_CACHE_MAX_BYTES', 10):
+            views.cache_put('a', b'x' * 4, 'image/png')
+            views.cache_put('b', b'x' * 4, 'image/png')
+            views.cache_put('c', b'x' * 4, 'image/png')
+
+        self.assertIsNone(views.cache_get('a'))
+        self.assertIsNotNone(views.cache_get('b'))
+        self.assertIsNotNone(views.cache_get('c'))
+        self.assertEqual(views._result_cache_bytes, 8)
+
+    def test_replacing_an_entry_updates_byte_count(self):
+        views.cache_put('a', b'x' * 4, 'image/png')
+        views.cache_put('a', b'x' * 6, 'image/png', 'a.png')
+        self.assertEqual(views._result_cache_bytes, 6)
+        self.assertEqual(views.cache_get('a')[2], 'a.png')
+
+
+class ResultResponseTests(SimpleTestCase):
+    def setUp(self):
+        clear_result_cache()
+        self.addCleanup(clear_result_cache)
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        patcher = mock.patch.dict(views.OUTPUT_DIRS, {'processed': self.output_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.request = RequestFactory().post('/api/remove-background/')
+
+    def respond(self, entry, filename):
+        return views.result_response(self.request, 'key', entry, 'processed', filename, 'done')
+
+    def test_writes_file_once_and_reuses_it(self):
+        entry = views.cache_put('key', b'png-bytes', 'image/png')
+        response = self.respond(entry, 'first.png')
+        self.assertTrue(response.data['processed_image_url'].endswith('/processed/first.png'))
+        with open(os.path.join(self.output_dir, 'first.png'), 'rb') as f:
+            self.assertEqual(f.read(), b'png-bytes')
+
+        response = self.respond(views.cache_get('key'), 'second.png')
+        self.assertTrue(response.data['processed_image_url'].endswith('/processed/first.png'))
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'second.png')))
+
+    def test_rewrites_deleted_file(self):
+        entry = views.cache_put('key', b'png-bytes', 'image/png')
+        self.respond(entry, 'first.png')
+        os.unlink(os.path.join(self.output_dir, 'first.png'))
+
+        response = self.respond(views.cache_get('key'), 'second.png')
+        self.assertTrue(response.data['processed_image_url'].endswith('/processed/second.png'))
+        with open(os.path.join(self.output_dir, 'second.png'), 'rb') as f:
+            self.assertEqual(f.read(), b'png-bytes')
+        self.assertEqual(views.cache_get('key')[2], 'second.png')
+
+    def test_inline_returns_body(self):
+        entry = views.cache_put('key', b'png-bytes', 'image/png')
+        response = views.result_response(self.request, 'key', entry, 'processed', 'x.png', 'done', inline=True)
+        self.assertEqual(response.content, b'png-bytes')
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+
+class NextUniqueIdTests(SimpleTestCase):
+    def test_unique_ids_differ(self):
+        self.assertNotEqual(next_unique_id(), next_unique_id())
+
+    def test_unique_ids_are_not_sequential(self):
+        first, second = next_unique_id(), next_unique_id()
+        # Names are published under MEDIA_URL; one must not reveal the next
+        self.assertNotEqual(first.rsplit('-', 1)[1], second.rsplit('-', 1)[1])
+        self.assertGreaterEqual(len(first.rsplit('-', 1)[1]), 16)
+
+
+class LetterboxTests(SimpleTestCase):
+    def assertCropsToContent(self, h, w):
+        img = np.zeros((h, w, 3), dtype=np.uint8)
+        boxed = _letterbox(img)
+        self.assertEqual(boxed.shape, (IMGSZ, IMGSZ, 3))
+
+        cropped = _crop_letterbox(boxed[..., 0], (h, w))
+        gain = IMGSZ / max(h, w)
+        self.assertLessEqual(abs(cropped.shape[0] - h * gain), 1.5)
+        self.assertLessEqual(abs(cropped.shape[1] - w * gain), 1.5)
+        # At most a one pixel sliver of padding survives rounding on each side
+        padded_rows = np.count_nonzero((cropped == 114).all(axis=1))
+        padded_cols = np.count_nonzero((cropped == 114).all(axis=0))
+        self.assertLessEqual(padded_rows, 2)
+        self.assertLessEqual(padded_cols, 2)
+
+    def test_portrait(self):
+        self.assertCropsToContent(480, 320)
+
+    def test_landscape(self):
+        self.assertCropsToContent(333, 1000)
+
+    def test_square_is_unpadded(self):
+        img = np.zeros((IMGSZ, IMGSZ, 3), dtype=np.uint8)
+        boxed = _letterbox(img)
+        self.assertEqual(_crop_letterbox(boxed[..., 0], (IMGSZ, IMGSZ)).shape, (IMGSZ, IMGSZ))
+
+    def test_low_resolution_mask_keeps_aspect(self):
+        # YOLO masks come out at a quarter of the letterboxed input
+        mask = np.zeros((IMGSZ // 4, IMGSZ // 4), dtype=np.float32)
+        cropped = _crop_letterbox(mask, (480, 320))
+        self.assertAlmostEqual(cropped.shape[1] / cropped.shape[0], 320 / 480, delta=0.02)
+
+
+class SoftAlphaTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # Hard-edged blobs, like a binarized YOLO mask
+        self.mask = (rng.random((120, 90)) > 0.5).astype(np.float32)
+
+    def test_stripes_match_single_resize(self):
+        size = (1203, 1607)
+        expected = cv2.convertScaleAbs(cv2.resize(self.mask, size, interpolation=cv2.INTER_LINEAR), alpha=255.0)
+
+        pool = ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(pool.shutdown)
+        with mock.patch.multiple(views, MASK_STRIPES=4, _STRIPE_POOL=pool, STRIPE_MIN_PIXELS=0):
+            striped = views.soft_alpha(self.mask, size).copy()
+
+        self.assertEqual(striped.shape, expected.shape)
+        # Same sample positions; only the last bit of rounding may differ
+        diff = np.abs(striped.astype(int) - expected.astype(int))
+        self.assertLessEqual(diff.max(), 1)
+        self.assertLess(diff.mean(), 0.01)
+
+    def test_single_call_without_pool(self):
+        size = (300, 400)
+        expected = cv2.convertScaleAbs(cv2.resize(self.mask, size, interpolation=cv2.INTER_LINEAR), alpha=255.0)
+        with mock.patch.object(views, '_STRIPE_POOL', None):
+            np.testing.assert_array_equal(views.soft_alpha(self.mask, size), expected)
+
+
+class ReceiveUploadTests(SimpleTestCase):
+    def setUp(self):
+        self.upload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.upload_dir)
+        self.data = os.urandom(200 * 1024)
+
+    def upload_file(self):
+        return SimpleUploadedFile('photo.jpg', self.data, content_type='image/jpeg')
+
+    def test_in_memory(self):
+        upload = receive_upload(self.upload_file(), self.upload_dir, keep_disk=False)
+        self.assertEqual(upload.data, self.data)
+        self.assertEqual(upload.digest, hashlib.blake2b(self.data, digest_size=16).digest())
+        self.assertIsNone(upload.path)
+        self.assertEqual(os.listdir(self.upload_dir), [])
+        discard_upload(upload)
+
+    def test_keep_disk(self):
+        upload = receive_upload(self.upload_file(), self.upload_dir, keep_disk=True)
+        self.assertEqual(upload.data, self.data)
+        self.assertEqual(upload.digest, hashlib.blake2b(self.data, digest_size=16).digest())
+        self.assertTrue(upload.path.endswith('_photo.jpg'))
+        with open(upload.path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+        discard_upload(upload)
+        self.assertFalse(os.path.exists(upload.path))
+
+
+class FakeBoxes:
+    def __init__(self, conf, xyxy):
+        self.conf = torch.tensor(conf, dtype=torch.float32)
+        self.xyxy = torch.tensor(xyxy, dtype=torch.float32).reshape(-1, 4)
+
+    def __len__(self):
+        return len(self.conf)
+
+
+class FakeMasks:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeResult:
+    """The parts of an ultralytics Results object the batcher reads."""
+
+    def __init__(self, orig_shape, conf, xyxy, masks=None):
+        self.orig_shape = orig_shape
+        self.boxes = FakeBoxes(conf, xyxy)
+        self.masks = None if masks is None else FakeMasks(masks)
+
+    def __getitem__(self, keep):
+        result = FakeResult(self.orig_shape, [], [])
+        result.boxes.conf = self.boxes.conf[keep]
+        result.boxes.xyxy = self.boxes.xyxy[keep]
+        result.masks = None if self.masks is None else FakeMasks(self.masks.data[keep])
+        return result
+
+
+class StubModel:
+    def __init__(self, results=None, error=None):
+        self.results = results
+        self.error = error
+        self.calls = []
+
+    def __call__(self, source, conf, classes, half, verbose):
+        self.calls.append((len(source), conf, classes))
+        if self.error is not None:
+            raise self.error
+        return self.results
+
+
+def detection_masks(*values):
+    """One 8x8 mask per detection, filled with the given value."""
+    return torch.stack([torch.full((8, 8), v, dtype=torch.float32) for v in values])
+
+
+class BatchSchedulerTests(SimpleTestCase):
+    shape = (16, 16)
+
+    def setUp(self):
+        patcher = mock.patch.object(inference_worker.torch.cuda, 'is_available', return_value=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_batch(self, model, confs):
+        scheduler = inference_worker.BatchScheduler(model)
+        img = np.zeros((IMGSZ, IMGSZ, 3), dtype=np.uint8)
+        batch = [(img, self.shape, conf, Future()) for conf in confs]
+        scheduler._run_batch(batch)
+        return [future for _, _, _, future in batch]
+
+    def test_batch_runs_at_lowest_conf_then_filters_per_request(self):
+        # A weak detection over the top half, a confident one over the bottom
+        masks = torch.zeros((2, 8, 8))
+        masks[0, :4] = 1.0
+        masks[1, 4:] = 1.0
+        results = [
+            FakeResult((IMGSZ, IMGSZ), [0.3, 0.9], [[0, 0, 8, 4], [0, 4, 8, 8]], masks)
+            for _ in range(2)
+        ]
+        model = StubModel(results)
+        strict, lenient = self.run_batch(model, [0.5, 0.2])
+
+        self.assertEqual(model.calls, [(2, 0.2, [0])])
+        np.testing.assert_array_equal(strict.result(), masks[1].numpy())
+        np.testing.assert_array_equal(lenient.result(), np.ones((8, 8), dtype=np.float32))
+
+    def test_results_are_demuxed_in_order(self):
+        results = [
+            FakeResult((IMGSZ, IMGSZ), [0.9], [[0, 0, 8, 8]], detection_masks(value))
+            for value in (0.1, 0.2, 0.3)
+        ]
+        futures = self.run_batch(StubModel(results), [0.25] * 3)
+        self.assertEqual([f.result()[0, 0] for f in futures], [np.float32(0.1), np.float32(0.2), np.float32(0.3)])
+
+    def test_single_detection_skips_reduction(self):
+        masks = detection_masks(0.5)
+        result = FakeResult((IMGSZ, IMGSZ), [0.9], [[0, 0, 8, 8]], masks)
+        with mock.patch.object(torch.Tensor, 'amax', side_effect=AssertionError('reduced')):
+            (future,) = self.run_batch(StubModel([result]), [0.25])
+
+        mask = future.result()
+        self.assertEqual(mask.dtype, np.float32)
+        np.testing.assert_array_equal(mask, masks[0].numpy())
+
+    def test_falls_back_to_boxes_without_masks(self):
+        result = FakeResult((16, 16), [0.9], [[2, 4, 10, 12]])
+        (future,) = self.run_batch(StubModel([result]), [0.25])
+
+        expected = np.zeros((16, 16), dtype=np.float32)
+        expected[4:12, 2:10] = 1.0
+        np.testing.assert_array_equal(future.result(), expected)
+
+    def test_exception_reaches_every_future(self):
+        error = RuntimeError('out of memory')
+        futures = self.run_batch(StubModel(error=error), [0.25, 0.5, 0.75])
+        for future in futures:
+            self.assertIs(future.exception(), error)
+
+
+@override_settings(KEEP_UPLOADS=False)
+class ViewTestCase(SimpleTestCase):
+    """Posts to the API views with YOLO replaced by a fixed mask."""
+
+    def setUp(self):
+        clear_result_cache()
+        self.addCleanup(clear_result_cache)
+        self.media_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_dir)
+        dirs = {name: os.path.join(self.media_dir, name) for name in ('uploads', 'processed', 'resized')}
+        for path in dirs.values():
+            os.makedirs(path)
+        self.start_patch(mock.patch.object(views, 'UPLOADS_DIR', dirs['uploads']))
+        self.start_patch(mock.patch.dict(views.OUTPUT_DIRS, {'processed': dirs['processed'], 'resized': dirs['resized']}))
+        self.infer = self.start_patch(mock.patch.object(
+            apps.get_app_config('api').client, 'infer',
+            return_value=np.ones((IMGSZ // 4, IMGSZ // 4), dtype=np.float32),
+        ))
+
+        img = np.zeros((48, 64, 3), dtype=np.uint8)
+        img[8:40, 16:48] = (0, 128, 255)
+        self.image_bytes = cv2.imencode('.png', img)[1].tobytes()
+
+    def start_patch(self, patcher):
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def post(self, view, path, **data):
+        data['image'] = SimpleUploadedFile('photo.png', self.image_bytes, content_type='image/png')
+        return view.as_view()(RequestFactory().post(path, data))
+
+    def remove_background(self, query='', **data):
+        return self.post(views.RemoveBackgroundView, f'/api/remove-background/{query}', **data)
+
+    def media_files(self):
+        return [name for _, _, files in os.walk(self.media_dir) for name in files]
+
+
+class OutputFormatTests(ViewTestCase):
+    def test_webp(self):
+        response = self.remove_background(output_format='webp')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['processed_image_url'].endswith('_no_bg.webp'))
+
+        (entry,) = views._RESULT_CACHE.values()
+        self.assertEqual(entry[1], 'image/webp')
+        self.assertEqual(entry[0][:4], b'RIFF')
+        self.assertEqual(entry[0][8:12], b'WEBP')
+
+    def test_unknown_format_is_rejected(self):
+        response = self.remove_background(output_format='gif')
+        self.assertEqual(response.status_code, 400)
+        self.infer.assert_not_called()
+        self.assertEqual(self.media_files(), [])
+
+
+class InlineResultTests(ViewTestCase):
+    def resize(self, query='', **data):
+        return self.post(views.ResizeImageView, f'/api/resize-image/{query}', **data)
+
+    def test_inline_returns_image_without_writing_files(self):
+        response = self.remove_background('?inline=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        bgra = cv2.imdecode(np.frombuffer(response.content, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        self.assertEqual(bgra.shape, (48, 64, 4))
+        self.assertEqual(self.media_files(), [])
+
+    def test_repeated_upload_is_served_from_cache(self):
+        first = self.remove_background('?inline=1')
+        second = self.remove_background('?inline=1')
+        self.assertEqual(self.infer.call_count, 1)
+        self.assertEqual(second.content, first.content)
+
+        # Different options are a different result
+        self.remove_background('?inline=1', confidence='0.5')
+        self.assertEqual(self.infer.call_count, 2)
+
+    def test_resize_inline_keeps_format(self):
+        response = self.resize('?inline=1', width='32', height='24')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        img = cv2.imdecode(np.frombuffer(response.content, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        self.assertEqual(img.shape[:2], (24, 32))
+        self.assertEqual(self.media_files(), [])
+
+    def test_resize_without_size_copies_upload(self):
+        response = self.resize('?inline=1')
+        self.assertEqual(response.content, self.image_bytes)
+
+        response = self.resize()
+        self.assertTrue(response.data['processed_image_url'].endswith('_resized_photo.png'))
+        (name,) = self.media_files()
+        with open(os.path.join(views.OUTPUT_DIRS['resized'], name), 'rb') as f:
+            self.assertEqual(f.read(), self.image_bytes)
@@ -1,104 +1,126 @@
 """
 API Views for Background Remover and Image Resizer
 """
+import collections
+import io
 import os
+import shutil
 import sys
-import uuid
+import threading
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from PIL import Image
 import cv2
 
+from django.apps import apps
 from django.conf import settings
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework import status
 
+from ._upload import discard_upload, receive_upload
+from .inference_client import server_threads
+
 # Add parent directory to path to import the background remover
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
 
-from ultralytics import YOLO
+# Media directories as plain strings; ApiConfig.ready() creates them
+UPLOADS_DIR = str(Path(settings.MEDIA_ROOT) / 'uploads')
+PROCESSED_DIR = str(Path(settings.MEDIA_ROOT) / 'processed')
+RESIZED_DIR = str(Path(settings.MEDIA_ROOT) / 'resized')
+MEDIA_DIRS = (UPLOADS_DIR, PROCESSED_DIR, RESIZED_DIR)
 
-# Global model instance (lazy loaded)
-_model = None
+# Output directory for each media URL prefix
+OUTPUT_DIRS = {'processed': PROCESSED_DIR, 'resized': RESIZED_DIR}
 
+# Per-thread full-size mask, reused while consecutive images share a size
+_MASK_BUF = threading.local()
+
+# Horizontal stripes of large masks are upsampled in parallel; OpenCV
+# releases the GIL. The pool gets the same thread budget as OpenCV itself,
+# so pinned server workers (the default) upsample in one call. Below
+# STRIPE_MIN_PIXELS one call is cheaper anyway.
+MASK_STRIPES = server_threads()
+_STRIPE_POOL = ThreadPoolExecutor(max_workers=MASK_STRIPES) if MASK_STRIPES > 1 else None
+STRIPE_MIN_PIXELS = 1024 * 1024
+
+# Recently produced results, keyed by upload hash and processing options
+RESULT_CACHE_MAX_ITEMS = 128
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+_RESULT_CACHE = collections.OrderedDict()
+_result_cache_bytes = 0
+_result_cache_lock = threading.Lock()
+
+# Encoder settings for the supported background-removal output formats
+ENCODE_PARAMS = {
+    'png': [cv2.IMWRITE_PNG_COMPRESSION, 1],
+    'webp': [cv2.IMWRITE_WEBP_QUALITY, 90],
+}
 
-def get_model(model_size='n'):
-    """Load and cache the YOLO model."""
-    global _model
-    if _model is None:
-        print(f"Loading YOLOv8{model_size}-seg model...")
-        try:
-            _model = YOLO(f'yolov11{model_size}-seg.pt')
-        except Exception:
-            try:
-                _model = YOLO(f'yolov10{model_size}-seg.pt')
-            except Exception:
-                _model = YOLO(f'yolov8{model_size}-seg.pt')
-        print("Model loaded successfully!")
-    return _model
 
+def _mask_buffer(size):
+    """Return this thread's full-size mask buffer for size (w, h)."""
+    w, h = size
+    buf = getattr(_MASK_BUF, 'v', None)
+    if buf is None or buf.shape != (h, w):
+        buf = _MASK_BUF.v = np.empty((h, w), dtype=np.uint8)
+    return buf
 
-def remove_background_yolo(img, model, class_id=0, conf_threshold=0.25):
+
+def soft_alpha(mask, size):
     """
-    Remove background using YOLO segmentation model.
+    Upsample a low-resolution 0-1 mask once to size (w, h) as 0-255 alpha.
+
+    Linear interpolation of YOLO's mask already gives smooth edges, so no
+    morphology, blur or threshold passes are needed at full size.
     """
-    results = model(img, conf=conf_threshold, classes=[class_id])
+    w, h = size
+    dst = _mask_buffer(size)
+    if _STRIPE_POOL is None or w * h < STRIPE_MIN_PIXELS:
+        mask = cv2.resize(mask, size, interpolation=cv2.INTER_LINEAR)
+        return cv2.convertScaleAbs(mask, dst=dst, alpha=255.0)
     
-    h, w = img.shape[:2]
-    mask = np.zeros((h, w), dtype=np.uint8)
+    mh, mw = mask.shape
+    sx, sy = mw / w, mh / h
     
-    if results and len(results) > 0:
-        result = results[0]
-        
-        if result.masks is not None and len(result.masks.data) > 0:
-            masks_data = result.masks.data.cpu().numpy()
-            
-            for seg_mask in masks_data:
-                if seg_mask.shape != (h, w):
-                    seg_mask = cv2.resize(seg_mask, (w, h), interpolation=cv2.INTER_NEAREST)
-                mask = np.maximum(mask, (seg_mask > 0.5).astype(np.uint8) * 255)
-        else:
-            boxes = result.boxes
-            if boxes is not None and len(boxes) > 0:
-                for box in boxes:
-                    x1, y1, x2, y2 = box.xyxy[0].cpu().numpy().astype(int)
-                    mask[y1:y2, x1:x2] = 255
+    def stripe(y0, y1):
+        # Same sample positions as cv2.resize, shifted to start at row y0
+        m = np.float32([[sx, 0, 0.5 * sx - 0.5], [0, sy, (y0 + 0.5) * sy - 0.5]])
+        up = cv2.warpAffine(mask, m, (w, y1 - y0), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                            borderMode=cv2.BORDER_REPLICATE)
+        cv2.convertScaleAbs(up, dst=dst[y0:y1], alpha=255.0)
     
-    return mask
+    bounds = np.linspace(0, h, MASK_STRIPES + 1, dtype=int)
+    list(_STRIPE_POOL.map(stripe, bounds[:-1], bounds[1:]))
+    return dst
 
 
-def process_image(input_path, output_path, conf_threshold=0.25):
-    """Process an image and remove its background."""
-    img = cv2.imread(str(input_path))
-    if img is None:
-        raise ValueError(f"Could not read image from {input_path}")
-    
-    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    
-    model = get_model()
-    mask = remove_background_yolo(img, model, class_id=0, conf_threshold=conf_threshold)
-    
-    # Refine mask
-    kernel = np.ones((3, 3), np.uint8)
-    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, iterations=1)
-    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, iterations=2)
-    mask = cv2.GaussianBlur(mask, (3, 3), 0)
-    mask = (mask > 127).astype(np.uint8) * 255
-    
-    # Create RGBA image
-    result_rgba = np.dstack((img_rgb, mask))
-    result_pil = Image.fromarray(result_rgba, 'RGBA')
-    result_pil.save(str(output_path), 'PNG')
+def encode_image(bgra, output_format='png'):
+    """Encode a BGRA image as PNG or WebP."""
+    ok, encoded = cv2.imencode(f'.{output_format}', bgra, ENCODE_PARAMS[output_format])
+    if not ok:
+        raise ValueError(f"Could not encode image as {output_format}")
+    return encoded
+
+
+def process_image_ndarray(img, conf_threshold=0.25, output_format='png'):
+    """Remove the background from a decoded BGR image and return it encoded."""
+    h, w = img.shape[:2]
+    mask = apps.get_app_config('api').client.infer(img, conf_threshold)
+    mask = soft_alpha(mask, (w, h))
     
-    return output_path
+    # Create the BGRA image OpenCV's encoders expect
+    bgra = np.empty((h, w, 4), dtype=np.uint8)
+    cv2.mixChannels([img, mask], [bgra], [0, 0, 1, 1, 2, 2, 3, 3])
+    return encode_image(bgra, output_format)
 
 
-def resize_image_file(input_path, output_path, width=None, height=None, scale=None):
-    """Resize an image."""
-    img = Image.open(input_path)
+def resize_image_file(image_file, destination, width=None, height=None, scale=None):
+    """Resize an image read from a file object into destination; return its format."""
+    img = Image.open(image_file)
     
     if scale is not None:
         # Resize by percentage
@@ -110,12 +132,65 @@ def resize_image_file(input_path, output_path, width=None, height=None, scale=No
         height = int(height)
     else:
         # Fallback if nothing provided
-        shutil.copy(input_path, output_path)
-        return
+        image_file.seek(0)
+        shutil.copyfileobj(image_file, destination)
+        return img.format
         
-    # High-quality resize
-    resized_img = img.resize((width, height), Image.Resampling.LANCZOS)
-    resized_img.save(str(output_path), quality=95)
+    # High-quality resize; for large downscales Pillow first shrinks with a
+    # cheap integer box reduce, so LANCZOS only handles the last ~2x
+    resized_img = img.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=2.0)
+    resized_img.save(destination, format=img.format, quality=95)
+    return img.format
+
+
+def cache_get(key):
+    """Return the cached (data, content_type, filename) entry for key, or None."""
+    with _result_cache_lock:
+        entry = _RESULT_CACHE.get(key)
+        if entry is not None:
+            _RESULT_CACHE.move_to_end(key)
+        return entry
+
+
+def cache_put(key, data, content_type, filename=None):
+    """Cache an encoded result, evicting the least recently used entries."""
+    global _result_cache_bytes
+    entry = (data, content_type, filename)
+    with _result_cache_lock:
+        old = _RESULT_CACHE.pop(key, None)
+        if old is not None:
+            _result_cache_bytes -= len(old[0])
+        _RESULT_CACHE[key] = entry
+        _result_cache_bytes += len(data)
+        while len(_RESULT_CACHE) > RESULT_CACHE_MAX_ITEMS or _result_cache_bytes > RESULT_CACHE_MAX_BYTES:
+            _, (evicted, _, _) = _RESULT_CACHE.popitem(last=False)
+            _result_cache_bytes -= len(evicted)
+    return entry
+
+
+def result_response(request, key, entry, subdir, filename, message, inline=False):
+    """
+    Return a processed result inline, or as a URL to its file in OUTPUT_DIRS[subdir].
+
+    The file is only written when the cached entry has none on disk yet.
+    """
+    data, content_type, output_filename = entry
+    if inline:
+        return HttpResponse(data, content_type=content_type)
+    
+    output_dir = OUTPUT_DIRS[subdir]
+    if output_filename is None or not os.path.exists(f"{output_dir}/{output_filename}"):
+        output_filename = filename
+        with open(f"{output_dir}/{output_filename}", 'wb') as destination:
+            destination.write(data)
+        cache_put(key, data, content_type, output_filename)
+    
+    processed_url = request.build_absolute_uri(f"{settings.MEDIA_URL}{subdir}/{output_filename}")
+    return Response({
+        'success': True,
+        'message': message,
+        'processed_image_url': processed_url,
+    }, status=status.HTTP_200_OK)
 
 
 def health_check(request):
@@ -131,42 +206,38 @@ class RemoveBackgroundView(APIView):
         if 'image' not in request.FILES:
             return Response({'error': 'No image file provided'}, status=status.HTTP_400_BAD_REQUEST)
         
-        image_file = request.FILES['image']
-        
-        # Save uploaded file
-        uploads_dir = settings.MEDIA_ROOT / 'uploads'
-        processed_dir = settings.MEDIA_ROOT / 'processed'
-        uploads_dir.mkdir(parents=True, exist_ok=True)
-        processed_dir.mkdir(parents=True, exist_ok=True)
+        # Not "format": DRF reserves that parameter for content negotiation
+        output_format = str(request.data.get('output_format', 'png')).lower()
+        if output_format not in ENCODE_PARAMS:
+            return Response({'error': 'output_format must be png or webp'}, status=status.HTTP_400_BAD_REQUEST)
         
-        unique_id = str(uuid.uuid4())[:8]
-        input_filename = f"{unique_id}_{image_file.name}"
-        input_path = uploads_dir / input_filename
+        # ?inline=1 returns the image in the response body instead of a URL
+        inline = request.query_params.get('inline') == '1'
         
-        with open(input_path, 'wb+') as destination:
-            for chunk in image_file.chunks():
-                destination.write(chunk)
+        image_file = request.FILES['image']
+        upload = receive_upload(image_file, UPLOADS_DIR)
         
         try:
             conf_threshold = float(request.data.get('confidence', 0.25))
             conf_threshold = max(0.0, min(1.0, conf_threshold))
             
-            output_filename = f"{unique_id}_no_bg.png"
-            output_path = processed_dir / output_filename
-            
-            process_image(input_path, output_path, conf_threshold)
-            
-            processed_url = request.build_absolute_uri(f"{settings.MEDIA_URL}processed/{output_filename}")
+            key = ('no_bg', upload.digest, round(conf_threshold, 3), output_format)
+            entry = cache_get(key)
+            if entry is None:
+                img = cv2.imdecode(np.frombuffer(upload.data, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if img is None:
+                    raise ValueError(f"Could not read image {image_file.name}")
+                
+                encoded = process_image_ndarray(img, conf_threshold, output_format)
+                entry = cache_put(key, encoded.tobytes(), f'image/{output_format}')
             
-            return Response({
-                'success': True,
-                'message': 'Background removed successfully',
-                'processed_image_url': processed_url,
-            }, status=status.HTTP_200_OK)
+            return result_response(
+                request, key, entry, 'processed', f"{upload.unique_id}_no_bg.{output_format}",
+                'Background removed successfully', inline,
+            )
             
         except Exception as e:
-            if input_path.exists():
-                input_path.unlink()
+            discard_upload(upload)
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
@@ -178,21 +249,11 @@ class ResizeImageView(APIView):
         if 'image' not in request.FILES:
             return Response({'error': 'No image file provided'}, status=status.HTTP_400_BAD_REQUEST)
         
-        image_file = request.FILES['image']
-        
-        # Save uploaded file
-        uploads_dir = settings.MEDIA_ROOT / 'uploads'
-        processed_dir = settings.MEDIA_ROOT / 'resized'
-        uploads_dir.mkdir(parents=True, exist_ok=True)
-        processed_dir.mkdir(parents=True, exist_ok=True)
+        # ?inline=1 returns the image in the response body instead of a URL
+        inline = request.query_params.get('inline') == '1'
         
-        unique_id = str(uuid.uuid4())[:8]
-        input_filename = f"{unique_id}_{image_file.name}"
-        input_path = uploads_dir / input_filename
-        
-        with open(input_path, 'wb+') as destination:
-            for chunk in image_file.chunks():
-                destination.write(chunk)
+        image_file = request.FILES['image']
+        upload = receive_upload(image_file, UPLOADS_DIR)
         
         try:
             # Get Parameters
@@ -203,20 +264,19 @@ class ResizeImageView(APIView):
             if scale:
                 scale = float(scale)
             
-            output_filename = f"{unique_id}_resized_{image_file.name}"
-            output_path = processed_dir / output_filename
-            
-            resize_image_file(input_path, output_path, width, height, scale)
-            
-            processed_url = request.build_absolute_uri(f"{settings.MEDIA_URL}resized/{output_filename}")
+            key = ('resized', upload.digest, width, height, scale)
+            entry = cache_get(key)
+            if entry is None:
+                output = io.BytesIO()
+                image_format = resize_image_file(io.BytesIO(upload.data), output, width, height, scale)
+                content_type = Image.MIME.get(image_format, 'application/octet-stream')
+                entry = cache_put(key, output.getvalue(), content_type)
             
-            return Response({
-                'success': True,
-                'message': 'Image resized successfully',
-                'processed_image_url': processed_url,
-            }, status=status.HTTP_200_OK)
+            return result_response(
+                request, key, entry, 'resized', f"{upload.unique_id}_resized_{image_file.name}",
+                'Image resized successfully', inline,
+            )
             
         except Exception as e:
-            if input_path.exists():
-                input_path.unlink()
+            discard_upload(upload)
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -113,3 +113,12 @@ REST_FRAMEWORK = {
 # File upload settings
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10 MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10 MB
+
+# Uploads are decoded straight from memory. Set KEEP_UPLOADS=1 to also keep
+# a copy of every upload in MEDIA_ROOT/uploads for debugging
+KEEP_UPLOADS = os.environ.get('KEEP_UPLOADS', '') == '1'
+
+# The inference worker starts on the first background-removal request, and
+# at boot under `manage.py runserver`. Set INFERENCE_WORKER_AUTOSTART=1 to
+# also start it at boot elsewhere, e.g. from gunicorn's master with --preload
+INFERENCE_WORKER_AUTOSTART = os.environ.get('INFERENCE_WORKER_AUTOSTART', '') == '1'
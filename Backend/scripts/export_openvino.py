@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Export the YOLO segmentation model to a compiled format at deploy time.
+
+OpenVINO FP16 is used on CPU hosts and TensorRT FP16 on CUDA hosts. The API
+picks the export up automatically when it sits next to the .pt weights, so
+run this from the Backend directory.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+from ultralytics import YOLO
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from api.inference_worker import MAX_BATCH
+
+
+def export_model(weights='yolov8n-seg.pt', fmt='openvino', imgsz=640):
+    """Export weights to fmt and return the path of the exported model."""
+    model = YOLO(weights)
+    if fmt == 'engine':
+        # Dynamic batch so the batch scheduler can send up to MAX_BATCH images
+        return model.export(format='engine', half=True, dynamic=True, batch=MAX_BATCH, imgsz=imgsz)
+    return model.export(format='openvino', half=True, dynamic=True, imgsz=imgsz)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the YOLO model to OpenVINO or TensorRT')
+    parser.add_argument(
+        'weights',
+        type=str,
+        nargs='?',
+        default='yolov8n-seg.pt',
+        help='Path to the .pt weights (default: yolov8n-seg.pt)'
+    )
+    parser.add_argument(
+        '--format',
+        type=str,
+        default=None,
+        choices=['openvino', 'engine'],
+        help='Export format (default: engine on CUDA hosts, openvino otherwise)'
+    )
+    parser.add_argument(
+        '--imgsz',
+        type=int,
+        default=640,
+        help='Inference image size (default: 640)'
+    )
+    args = parser.parse_args()
+
+    fmt = args.format
+    if fmt is None:
+        import torch
+        fmt = 'engine' if torch.cuda.is_available() else 'openvino'
+
+    path = export_model(args.weights, fmt, args.imgsz)
+    print(f"Exported model saved to: {path}")
+
+
+if __name__ == '__main__':
+    main()